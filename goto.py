@@ -1,7 +1,16 @@
-from dataclasses import dataclass
+from dataclasses import dataclass, field
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor
 from sys import version_info
-from warnings import warn
 import typing as t
+import functools
+import argparse
+import warnings
+import ast
+import inspect
+import hashlib
+import pathlib
+import weakref
 import types
 import dis
 
@@ -12,7 +21,7 @@ label: t.Any = None
 
 
 if version_info[:2] >= (3, 10):
-    warn("goto with python >=3.10 is very unstable, make sure all tests passed")
+    warnings.warn("goto with python >=3.10 is very unstable, make sure all tests passed")
 elif version_info[:2] != (3, 9):
     raise NotImplementedError("goto requires python 3.9 or above")
 
@@ -76,16 +85,272 @@ class _Label:
     block: t.Sequence[int]
 
 
+@dataclass
+class _Patched:
+    digest: str  # digest of the original code
+    original: types.CodeType
+    code: types.CodeType  # patched code
+    jump_into_for: bool
+    # the patched function objects, the value is (module spec, definition order) when they were
+    # patched. importlib.reload sets a new spec, so it tells the executions of the module apart.
+    # the definition order tells apart the functions with the same qualified name in one execution,
+    # e.g. the getter and setter of a property
+    functions: 'weakref.WeakKeyDictionary[types.FunctionType, t.Tuple[t.Any, int]]' = \
+        field(default_factory=weakref.WeakKeyDictionary)
+    # the module spec of the last execution, and the number of definitions in it
+    spec: t.Any = None
+    count: int = 0
+
+
 F = t.TypeVar("F", bound=t.Callable[..., t.Any])
 
 
-def with_goto(func: F) -> F:
-    func.__code__ = patch(func.__code__)
+# the patched functions, the key is (module name, qualified name).
+# used to avoid patching the unchanged functions again when the module is reloaded
+_registry: t.Dict[t.Tuple[t.Optional[str], str], _Patched] = {}
+
+# the (patched code, original code, jump_into_for) of every patched function
+_functions: 'weakref.WeakKeyDictionary[types.FunctionType, t.Tuple[types.CodeType, types.CodeType, bool]]' = \
+    weakref.WeakKeyDictionary()
+
+
+@t.overload
+def with_goto(func: F) -> F: ...
+@t.overload
+def with_goto(*, jump_into_for: bool = ...) -> t.Callable[[F], F]: ...
+
+
+def with_goto(func: t.Optional[F] = None, *, jump_into_for: bool = False) -> t.Any:
+    """
+    patch the code of `func`.
+    can be used as `@with_goto` or `@with_goto(jump_into_for=True)`, see `patch`.
+    """
+    if func is None:
+        return functools.partial(with_goto, jump_into_for=jump_into_for)
+
+    patched, repatched = _patch_function(func, jump_into_for)
+    if "<locals>" in func.__qualname__:
+        # nested functions are separate objects, never update each other
+        patched.functions[func] = (None, -1)
+        return func
+
+    spec = func.__globals__.get("__spec__", None)
+    if patched.spec is not spec:
+        patched.spec, patched.count = spec, 0
+    order = patched.count
+    patched.count += 1
+
+    # a module-level function or method defined again by importlib.reload replaces the
+    # function object defined at the same place by the previous executions of the module,
+    # update them so references held elsewhere run the new code too
+    if repatched:
+        for old_func, (old_spec, old_order) in list(patched.functions.items()):
+            if (old_spec is not spec
+                and old_order == order
+                and old_func.__globals__ is func.__globals__
+                and old_func.__code__.co_freevars == patched.code.co_freevars):
+                old_func.__code__ = patched.code
+    patched.functions[func] = (spec, order)
     return func
 
 
-def patch(code: types.CodeType) -> types.CodeType:
+def _patch_function(func: F, jump_into_for: bool) -> t.Tuple[_Patched, bool]:
+    """
+    patch the code of `func`, reuse the previous patched code if the code is unchanged.
+    returns the registry entry and whether the code is patched again.
+    """
+    key = (func.__module__, func.__qualname__)
+    digest = _digest(func.__code__)
+
+    patched = _registry.get(key, None)
+    repatched = (patched is None or patched.digest != digest
+                 or patched.jump_into_for != jump_into_for)
+    if repatched:
+        code = patch(func.__code__, jump_into_for)
+        if patched is None:
+            patched = _registry[key] = _Patched(digest, func.__code__, code, jump_into_for)
+        else:
+            patched.digest, patched.original, patched.code = digest, func.__code__, code
+            patched.jump_into_for = jump_into_for
+
+    _functions[func] = (patched.code, func.__code__, jump_into_for)  # type: ignore
+    func.__code__ = patched.code
+    return patched, repatched
+
+
+def repatch(module: types.ModuleType) -> None:
+    """
+    patch the functions of `module` whose code has been replaced since they were patched.
+    the functions with unchanged code reuse the previous patched code.
+    """
+    for (module_name, _), patched in list(_registry.items()):
+        if module_name != module.__name__:
+            continue
+
+        for func in list(patched.functions):
+            if func.__code__ is not _functions[func][0]:
+                _patch_function(func, patched.jump_into_for)
+
+
+class _Unbound:
+    """the default value of the local variables that are not passed to an entry variant (see `entry`)"""
+
+    def __repr__(self) -> str:
+        return "<unbound>"
+
+
+_unbound = _Unbound()
+
+# the code of the entry variants, for each original code and (label name, jump_into_for)
+_entries: 'weakref.WeakKeyDictionary[types.CodeType, t.Dict[t.Tuple[str, bool], types.CodeType]]' = \
+    weakref.WeakKeyDictionary()
+
+
+def entry(func: t.Callable[..., t.Any], name: str) -> t.Callable[..., t.Any]:
+    """
+    make a variant of `func` that starts by jumping to label `name`.
+    the variant takes the local variables as keyword arguments, the others are unbound.
+
+    >>> resume = entry(func, "checkpoint")
+    >>> resume(i=10, total=45)
+    """
+    original = func.__code__  # type: ignore
+    jump_into_for = False
+    if func in _functions:
+        patched_code, patched_original, patched_jump_into_for = _functions[func]  # type: ignore
+        if patched_code is func.__code__:  # type: ignore
+            original, jump_into_for = patched_original, patched_jump_into_for
+
+    codes = _entries.setdefault(original, {})
+    code = codes.get((name, jump_into_for), None)
+    if code is None:
+        with _error_filename(original.co_filename):
+            code = codes[name, jump_into_for] = _patch_entry(original, name, jump_into_for)
+
+    # keep the default values of the parameters
+    kwdefaults = dict.fromkeys(code.co_varnames, _unbound)
+    if func.__defaults__:
+        params = original.co_varnames[:original.co_argcount]
+        kwdefaults.update(zip(params[len(params) - len(func.__defaults__):], func.__defaults__))
+    kwdefaults.update(func.__kwdefaults__ or {})
+    varargs, _ = _get_var_parameters(original)
+    if varargs is not None:
+        kwdefaults[varargs] = ()
+    # **kwargs is a new dict for every call, made by the prologue (see `_patch_entry`)
+
+    variant = types.FunctionType(code, func.__globals__, func.__name__, None, func.__closure__)
+    variant.__kwdefaults__ = kwdefaults
+    variant.__qualname__ = func.__qualname__
+    return variant
+
+
+def patch(code: types.CodeType, jump_into_for: bool = False) -> types.CodeType:
+    """
+    remove the labels and replace the gotos with jumps.
+    if `jump_into_for` is true, gotos can jump into a `for` loop body, the iterator of the loop
+    is kept in a hidden local variable. the goto raises UnboundLocalError if the loop was never started.
+    """
+    co_consts = list(code.co_consts)
+    co_varnames = list(code.co_varnames)
+    with _error_filename(code.co_filename):
+        instructions, _ = _rewrite(code, co_consts, co_varnames if jump_into_for else None)
+    return _assemble(code, instructions, co_consts,
+                     co_varnames=tuple(co_varnames), co_nlocals=len(co_varnames))
+
+
+def _patch_entry(code: types.CodeType, name: str, jump_into_for: bool = False) -> types.CodeType:
+    """patch `code` to start at label `name`, see `entry` and `patch`"""
     co_consts = list(code.co_consts)
+    co_varnames = list(code.co_varnames)
+    instructions, labels = _rewrite(code, co_consts, co_varnames if jump_into_for else None)
+
+    label = next((label for name_i, label in labels.items() if code.co_names[name_i] == name), None)
+    if label is None:
+        raise ValueError(f"label {name!r} not defined in function {code.co_name!r}")
+    index, _ = _find_by_id(instructions, label.ins.id)
+
+    co_consts.append(_unbound)
+    unbound_i = len(co_consts) - 1
+
+    # every local variable is a keyword-only argument. the local variables that only live in a
+    # cell (used by a nested function) are added too, the argument is copied to the cell when
+    # the frame starts
+    co_varnames.extend(name for name in code.co_cellvars if name not in co_varnames)
+
+    # delete the local variables that are not passed, **kwargs is an empty dict instead
+    _, varkeywords = _get_var_parameters(code)
+    prologue: t.List[_Instruction] = []
+    skips: t.List[t.Tuple[_Instruction, int]] = []  # the jump, and the index of its target
+    for i, varname in enumerate(co_varnames):
+        if varname in code.co_cellvars:
+            load, store, delete, arg = ("LOAD_DEREF", "STORE_DEREF", "DELETE_DEREF",
+                                        code.co_cellvars.index(varname))
+        else:
+            load, store, delete, arg = "LOAD_FAST", "STORE_FAST", "DELETE_FAST", i
+
+        skip = _Instruction(dis.opmap["POP_JUMP_IF_FALSE"], 0)
+        prologue.extend((
+            _Instruction(dis.opmap[load], arg),
+            _Instruction(dis.opmap["LOAD_CONST"], unbound_i),
+            _Instruction(dis.opmap["IS_OP"], 0),
+            skip
+        ))
+        if varname == varkeywords:
+            prologue.extend((
+                _Instruction(dis.opmap["BUILD_MAP"], 0),
+                _Instruction(dis.opmap[store], arg)
+            ))
+        else:
+            prologue.append(_Instruction(dis.opmap[delete], arg))
+        skips.append((skip, len(prologue)))
+
+    # implicit push block, then jump to the label
+    prologue.extend(reversed(list(_get_block_ins(instructions, co_consts, (), label.block, index))))
+    jump = _Instruction(dis.opmap["JUMP_ABSOLUTE"], 0)
+    jump.jump_target = label.ins.id
+    prologue.append(jump)
+
+    for skip, target_i in skips:
+        skip.jump_target = prologue[target_i].id
+
+    instructions[0:0] = prologue
+
+    return _assemble(
+        code,
+        instructions,
+        co_consts,
+        co_varnames=tuple(co_varnames),
+        co_nlocals=len(co_varnames),
+        co_argcount=0,
+        co_posonlyargcount=0,
+        co_kwonlyargcount=len(co_varnames),
+        co_flags=code.co_flags & ~(inspect.CO_VARARGS | inspect.CO_VARKEYWORDS),
+        co_stacksize=max(code.co_stacksize, 2)
+    )
+
+
+def _get_var_parameters(code: types.CodeType) -> t.Tuple[t.Optional[str], t.Optional[str]]:
+    """returns the name of the *args and **kwargs parameters"""
+    i = code.co_argcount + code.co_kwonlyargcount
+    varargs = varkeywords = None
+    if code.co_flags & inspect.CO_VARARGS:
+        varargs = code.co_varnames[i]
+        i += 1
+    if code.co_flags & inspect.CO_VARKEYWORDS:
+        varkeywords = code.co_varnames[i]
+    return varargs, varkeywords
+
+
+def _rewrite(
+    code: types.CodeType,
+    co_consts: t.MutableSequence[t.Any],
+    co_varnames: t.Optional[t.MutableSequence[str]] = None
+) -> t.Tuple[t.List[_Instruction], t.Dict[int, _Label]]:
+    """
+    remove the labels and replace the gotos with jumps, returns the instructions and labels.
+    if `co_varnames` is given, the iterator of every `for` loop entered by a goto is stored
+    in a hidden local variable, appended to `co_varnames`.
+    """
     instructions = list(_get_instructions(code))
     gotos, labels = _find_goto_and_label(code, instructions)
 
@@ -94,7 +359,7 @@ def patch(code: types.CodeType) -> types.CodeType:
         index, ins = _find_by_id(instructions, label.ins.id)
         assert ins is not None
         # delete LOAD_GLOBAL label, LOAD_ATTR, POP_TOP
-        del instructions[index:index + 3]
+        _delete_instructions(instructions, index, index + 3)
 
         jump_referrer = _find_jump_referrer(ins, instructions)
         for referrer_ins in jump_referrer:
@@ -102,16 +367,38 @@ def patch(code: types.CodeType) -> types.CodeType:
 
         label.ins = instructions[index]
 
+    # store the iterator of the entered loops, right after GET_ITER.
+    # the key is the FOR_ITER instruction id, the value is the local variable index
+    iterators: t.Optional[t.Dict[int, int]] = None
+    if co_varnames is not None:
+        iterators = {}
+        for goto in gotos:
+            target_label = labels.get(goto.target, None)
+            if target_label is None:
+                continue
+
+            for ins_id in target_label.block:
+                i, ins = _find_by_id(instructions, ins_id)
+                if ins_id in goto.block or ins_id in iterators or not _is_for_loop(instructions, i):
+                    continue
+
+                iterators[ins_id] = len(co_varnames)
+                _delete_iterator_on_exit(instructions, i, len(co_varnames))
+                instructions[i:i] = (
+                    _Instruction(dis.opmap["DUP_TOP"], 0),
+                    _Instruction(dis.opmap["STORE_FAST"], len(co_varnames))
+                )
+                co_varnames.append(f".for{len(iterators) - 1}")
+
     # remove gotos and refer to its target/label
     for goto in gotos:
         index, _ = _find_by_id(instructions, goto.ins.id)
         # delete LOAD_ATTR, POP_TOP
-        del instructions[index + 1:index + (1 + 2)]
+        _delete_instructions(instructions, index + 1, index + (1 + 2))
 
         target_label = labels.get(goto.target, None)
         if target_label is None:
-            raise SyntaxError(f"label {code.co_names[goto.target]!r} not defined in this function."
-                              f" at line {_take_min_lineno(instructions, index)}")
+            raise _label_not_defined(code, goto, instructions, index)
 
         _, jump_target_ins = _find_by_id(instructions, target_label.ins.id)
 
@@ -120,30 +407,84 @@ def patch(code: types.CodeType) -> types.CodeType:
 
         # implicit push/pop block
         ins = None
-        for ins in _get_block_ins(instructions, co_consts, goto.block, target_label.block, index):
+        for ins in _get_block_ins(instructions, co_consts, goto.block, target_label.block, index,
+                                  iterators):
             instructions.insert(index, ins)
         if ins is not None:
-            # shift lineno
+            # shift lineno, the inserted instructions belong to the goto line
             instructions[index].lineno, goto.ins.lineno = goto.ins.lineno, None
             # shift referrer target (jump_target)
             jump_referrer = _find_jump_referrer(goto.ins, instructions)
             for referrer_ins in jump_referrer:
                 referrer_ins.jump_target = instructions[index].id
 
+    return instructions, labels
+
+
+def _assemble(
+    code: types.CodeType,
+    instructions: t.MutableSequence[_Instruction],
+    co_consts: t.Sequence[t.Any],
+    **kwargs: t.Any
+) -> types.CodeType:
+    """make a code object from the instructions, `kwargs` are passed to `code.replace`"""
+    # remove unused names (goto, label and the label names) and constants.
+    # co_consts[0] is kept, it is the docstring of a function
+    co_names = _compact_table(instructions, code.co_names, dis.hasname)
+    compact_consts = _compact_table(instructions, co_consts, dis.hasconst, keep=(0,))
+
     if _is_39():
         return code.replace(
             co_code=bytes(_compile(instructions)),
             co_lnotab=bytes(_encode_lineno_39(code.co_firstlineno, instructions)),
-            co_consts=tuple(co_consts)
+            co_consts=compact_consts,
+            co_names=co_names,
+            **kwargs
         )
     else:
         return code.replace(
             co_code=bytes(_compile(instructions)),
             co_linetable=bytes(_encode_lineno_310(code.co_firstlineno, instructions)),
-            co_consts=tuple(co_consts)
+            co_consts=compact_consts,
+            co_names=co_names,
+            **kwargs
         )  # type: ignore
 
 
+def _digest(code: types.CodeType) -> str:
+    """digest of the bytecode, line number table, and everything else that affects patching"""
+    h = hashlib.sha1()
+    _update_digest(h, code)
+    return h.hexdigest()
+
+
+def _update_digest(h: t.Any, code: types.CodeType) -> None:
+    h.update(code.co_code)
+    h.update(code.co_lnotab)
+    h.update(repr((
+        code.co_filename,
+        code.co_name,
+        code.co_firstlineno,
+        code.co_flags,
+        code.co_argcount,
+        code.co_posonlyargcount,
+        code.co_kwonlyargcount,
+        code.co_nlocals,
+        code.co_stacksize,
+        code.co_names,
+        code.co_varnames,
+        code.co_freevars,
+        code.co_cellvars
+    )).encode())
+
+    for const in code.co_consts:
+        if isinstance(const, types.CodeType):
+            _update_digest(h, const)
+        else:
+            # the type distinguishes 1, 1.0 and True
+            h.update(repr((type(const), const)).encode())
+
+
 def _is_39() -> bool:
     return version_info[:2] == (3, 9)
 
@@ -170,6 +511,27 @@ def _compile(instructions: t.MutableSequence[_Instruction]) -> t.Generator[int,
         yield from (ins.opcode, arg)
 
 
+def _compact_table(
+    instructions: t.Iterable[_Instruction],
+    table: t.Sequence[t.Any],
+    opcodes: t.Container[int],
+    keep: t.Iterable[int] = ()
+) -> t.Tuple[t.Any, ...]:
+    """
+    remove the items of `table` (co_names or co_consts) that are not referenced by any of
+    `opcodes`, and renumber the argument of the instructions. the order of the items is preserved.
+    """
+    used = {i for i in keep if i < len(table)}
+    used.update(ins.arg for ins in instructions if ins.opcode in opcodes)
+
+    mapping = {old: new for new, old in enumerate(sorted(used))}
+    for ins in instructions:
+        if ins.opcode in opcodes:
+            ins.arg = mapping[ins.arg]
+
+    return tuple(table[i] for i in sorted(used))
+
+
 def _extend_args(instructions: t.MutableSequence[_Instruction]) -> None:
     """
     extend the argument of every instructions that is greater than 0xff.
@@ -206,97 +568,163 @@ def _get_block_ins(
     co_consts: t.MutableSequence[t.Any],
     origin: t.Sequence[int],
     target: t.Sequence[int],
-    origin_i: int  # for better error message
+    origin_i: int,  # for better error message
+    iterators: t.Optional[t.Mapping[int, int]] = None
 ) -> t.Generator[_Instruction, None, None]:
-    """calculate what instructions are needed to exit/enter a block correctly"""
-    if len(origin) > len(target):
-        # exit block / goto outer scope
-        if origin[:len(target)] != target:
-            raise SyntaxError("jump into different block."
-                              f" at line {_take_min_lineno(instructions, origin_i)}")
-
-        for ins_id in origin[len(target):]:
-            i, ins = _find_by_id(instructions, ins_id)
-            assert ins is not None
-            opname = dis.opname[ins.opcode]
-            if opname == "FOR_ITER":
-                yield _Instruction(dis.opmap["POP_TOP"], 0)
-            elif opname == "SETUP_FINALLY":
-                yield _Instruction(dis.opmap["POP_BLOCK"], 0)
-            elif ins.is_except_start:
-                if (
-                    # the except: ... syntax
-                    "POP_TOP"
-                    == opname
-                    == dis.opname[instructions[i+1].opcode]
-                    == dis.opname[instructions[i+2].opcode]
-                ) or (
-                    # the except Exc: ... syntax
-                    # or except (Exc1, Exc2): ...
-                    opname == "DUP_TOP"
-                ):
-                    yield _Instruction(dis.opmap["POP_EXCEPT"], 0)
-                else:
-                    yield from reversed((
-                        _Instruction(dis.opmap["POP_TOP"], 0),
-                        _Instruction(dis.opmap["POP_TOP"], 0),
-                        _Instruction(dis.opmap["POP_TOP"], 0),
-                        _Instruction(dis.opmap["POP_EXCEPT"], 0)
-                    ))
-            elif opname == "SETUP_WITH":
-                if None not in co_consts:
-                    co_consts.append(None)
-                yield from reversed((
-                    _Instruction(dis.opmap["POP_BLOCK"], 0),
-                    _Instruction(dis.opmap["LOAD_CONST"], co_consts.index(None)),
-                    _Instruction(dis.opmap["DUP_TOP"], 0),
-                    _Instruction(dis.opmap["DUP_TOP"], 0),
-                    _Instruction(dis.opmap["CALL_FUNCTION"], 3),
-                    _Instruction(dis.opmap["POP_TOP"], 0)
-                ))
-            elif opname == "SETUP_ASYNC_WITH":
-                if None not in co_consts:
-                    co_consts.append(None)
-                none_i = co_consts.index(None)
+    """
+    calculate what instructions are needed to exit/enter a block correctly.
+    the blocks of `origin` that are not in `target` are exited, then the blocks of `target`
+    that are not in `origin` are entered. sibling blocks are only allowed if `iterators` is given.
+    `iterators` is the local variable index of the iterator of the `for` loops that can be entered.
+    the instructions are yielded in reverse order, they are inserted at the same index.
+    """
+    # the number of blocks shared by origin and target
+    common = 0
+    while common < min(len(origin), len(target)) and origin[common] == target[common]:
+        common += 1
+    if common < min(len(origin), len(target)) and iterators is None:
+        # jumping between sibling blocks is only supported with jump_into_for
+        raise _syntax_error("jump into different block", instructions, origin_i)
+
+    # enter block / goto inner scope
+    for ins_id in reversed(target[common:]):
+        _, ins = _find_by_id(instructions, ins_id)
+        assert ins is not None
+        opname = dis.opname[ins.opcode]
+        if opname == "SETUP_FINALLY":
+            ins_copy = _Instruction(ins.opcode, ins.arg)
+            ins_copy.jump_target = ins.jump_target
+            yield ins_copy
+        elif opname == "FOR_ITER" and iterators is not None and ins_id in iterators:
+            # push the iterator back, as if the loop had reached this point
+            yield _Instruction(dis.opmap["LOAD_FAST"], iterators[ins_id])
+        elif (opname in ("SETUP_WITH", "SETUP_ASYNC_WITH", "FOR_ITER")
+              or ins.is_except_start):
+            raise _syntax_error("can't jump into 'with', 'for', 'except', and 'finally' block",
+                                instructions, origin_i)
+        else:
+            raise _syntax_error(f"unsupported block instruction: {opname}", instructions, origin_i)
+
+    # exit block / goto outer scope
+    for ins_id in origin[common:]:
+        i, ins = _find_by_id(instructions, ins_id)
+        assert ins is not None
+        opname = dis.opname[ins.opcode]
+        if opname == "FOR_ITER":
+            yield _Instruction(dis.opmap["POP_TOP"], 0)
+        elif opname == "SETUP_FINALLY":
+            yield _Instruction(dis.opmap["POP_BLOCK"], 0)
+        elif ins.is_except_start:
+            if (
+                # the except: ... syntax
+                "POP_TOP"
+                == opname
+                == dis.opname[instructions[i+1].opcode]
+                == dis.opname[instructions[i+2].opcode]
+            ) or (
+                # the except Exc: ... syntax
+                # or except (Exc1, Exc2): ...
+                opname == "DUP_TOP"
+            ):
+                yield _Instruction(dis.opmap["POP_EXCEPT"], 0)
+            else:
                 yield from reversed((
-                    _Instruction(dis.opmap["POP_BLOCK"], 0),
-                    _Instruction(dis.opmap["LOAD_CONST"], none_i),
-                    _Instruction(dis.opmap["DUP_TOP"], 0),
-                    _Instruction(dis.opmap["DUP_TOP"], 0),
-                    _Instruction(dis.opmap["CALL_FUNCTION"], 3),
-                    _Instruction(dis.opmap["GET_AWAITABLE"], 0),
-                    _Instruction(dis.opmap["LOAD_CONST"], none_i),
-                    _Instruction(dis.opmap["YIELD_FROM"], 0),
-                    _Instruction(dis.opmap["POP_TOP"], 0)
+                    _Instruction(dis.opmap["POP_TOP"], 0),
+                    _Instruction(dis.opmap["POP_TOP"], 0),
+                    _Instruction(dis.opmap["POP_TOP"], 0),
+                    _Instruction(dis.opmap["POP_EXCEPT"], 0)
                 ))
-            else:
-                assert False, f"unsupported block instruction: {opname}"
-    elif len(origin) < len(target):
-        # enter block / goto inner scope
-        if target[:len(origin)] != origin:
-            raise SyntaxError("jump into different block."
-                              f" at line {_take_min_lineno(instructions, origin_i)}")
-
-        for ins_id in reversed(target[len(origin):]):
-            _, ins = _find_by_id(instructions, ins_id)
-            assert ins is not None
-            opname = dis.opname[ins.opcode]
-            if opname == "SETUP_FINALLY":
-                ins_copy = _Instruction(ins.opcode, ins.arg)
-                ins_copy.jump_target = ins.jump_target
-                yield ins_copy
-            elif (opname in ("SETUP_WITH", "SETUP_ASYNC_WITH", "FOR_ITER")
-                  or ins.is_except_start):
-                raise SyntaxError("can't jump into 'with', 'for', 'except', and 'finally' block."
-                                  f" at line {_take_min_lineno(instructions, origin_i)}")
-            else:
-                assert False, f"unsupported block instruction: {opname}"
-    elif origin == target:
-        # on the same block / normal goto
-        pass
-    else:
-        raise SyntaxError("jump into different block."
-                          f" at line {_take_min_lineno(instructions, origin_i)}")
+        elif opname == "SETUP_WITH":
+            if None not in co_consts:
+                co_consts.append(None)
+            yield from reversed((
+                _Instruction(dis.opmap["POP_BLOCK"], 0),
+                _Instruction(dis.opmap["LOAD_CONST"], co_consts.index(None)),
+                _Instruction(dis.opmap["DUP_TOP"], 0),
+                _Instruction(dis.opmap["DUP_TOP"], 0),
+                _Instruction(dis.opmap["CALL_FUNCTION"], 3),
+                _Instruction(dis.opmap["POP_TOP"], 0)
+            ))
+        elif opname == "SETUP_ASYNC_WITH":
+            if None not in co_consts:
+                co_consts.append(None)
+            none_i = co_consts.index(None)
+            yield from reversed((
+                _Instruction(dis.opmap["POP_BLOCK"], 0),
+                _Instruction(dis.opmap["LOAD_CONST"], none_i),
+                _Instruction(dis.opmap["DUP_TOP"], 0),
+                _Instruction(dis.opmap["DUP_TOP"], 0),
+                _Instruction(dis.opmap["CALL_FUNCTION"], 3),
+                _Instruction(dis.opmap["GET_AWAITABLE"], 0),
+                _Instruction(dis.opmap["LOAD_CONST"], none_i),
+                _Instruction(dis.opmap["YIELD_FROM"], 0),
+                _Instruction(dis.opmap["POP_TOP"], 0)
+            ))
+        else:
+            raise _syntax_error(f"unsupported block instruction: {opname}", instructions, origin_i)
+
+
+def _delete_iterator_on_exit(
+    instructions: t.MutableSequence[_Instruction],
+    index: int,
+    varnum: int
+) -> None:
+    """
+    delete the hidden local variable `varnum` when the loop of the FOR_ITER at `index` is exhausted
+    or left by `break`, so a goto can't enter the loop with a finished iterator.
+    """
+    for_iter = instructions[index]
+    end, _ = _find_by_id(instructions, for_iter.jump_target)
+
+    # break: jump out of the loop body, after popping the iterator
+    for i in reversed(range(index + 1, end)):
+        ins = instructions[i]
+        if dis.opname[ins.opcode] not in ("JUMP_ABSOLUTE", "JUMP_FORWARD"):
+            continue
+        target_i, _ = _find_by_id(instructions, ins.jump_target)
+        if target_i < end:
+            continue
+        delete = _Instruction(dis.opmap["DELETE_FAST"], varnum)
+        delete.lineno, ins.lineno = ins.lineno, None
+        for referrer_ins in _find_jump_referrer(ins, instructions):
+            referrer_ins.jump_target = delete.id
+        instructions.insert(i, delete)
+
+    # exhausted: the end of the loop is only reached by a jump, the body ends by jumping back
+    end, _ = _find_by_id(instructions, for_iter.jump_target)
+    delete = _Instruction(dis.opmap["DELETE_FAST"], varnum)
+    for_iter.jump_target = delete.id
+    instructions.insert(end, delete)
+
+
+def _is_for_loop(instructions: t.Sequence[_Instruction], index: int) -> bool:
+    """whether instructions[index] is the FOR_ITER of a `for` statement, right after its GET_ITER"""
+    return (
+        dis.opname[instructions[index].opcode] == "FOR_ITER"
+        and index > 0
+        and dis.opname[instructions[index - 1].opcode] == "GET_ITER"
+    )
+
+
+def _delete_instructions(
+    instructions: t.MutableSequence[_Instruction],
+    start: int,
+    stop: int
+) -> None:
+    """
+    delete instructions[start:stop].
+    if the deleted instructions start a line, the line is passed to the next instruction
+    (unless it already starts a line), so the code after it is not attributed to the previous line.
+    for example `label .name; x = 1`
+    """
+    lineno = None
+    for ins in instructions[start:stop]:
+        if ins.lineno is not None:
+            lineno = ins.lineno
+
+    del instructions[start:stop]
+    if lineno is not None and start < len(instructions) and instructions[start].lineno is None:
+        instructions[start].lineno = lineno
 
 
 def _find_jump_referrer(
@@ -358,7 +786,11 @@ def _encode_lineno_39(
             yield from (0, 0x7f) * div
             yield from (0, mod)
         elif rline < 0:
-            yield from (0, 0x100 + rline)
+            # a signed byte, not fit for less than -0x80
+            div, mod = divmod(-rline, 0x80)
+            yield from (0, 0x80) * div
+            if mod:
+                yield from (0, 0x100 - mod)
         else:
             yield from (0, rline)
 
@@ -368,25 +800,61 @@ def _encode_lineno_39(
 def _encode_lineno_310(
     firstlineno: int,
     instructions: t.Sequence[_Instruction]
-) -> bytearray:
-    # this function is untested...
-    # please run the test yourself...
-    # make sure you are using python 3.10
-    lnotab = bytearray(_encode_lineno_39(firstlineno, instructions))
-    # shift offset_incr -1
-    i = 0
-    while i < len(lnotab)-2:
-        lnotab[i] = lnotab[i + 2]
-        i += 2
-    lnotab[-2] = len(lnotab)
-    return lnotab
+) -> t.Generator[int, None, None]:
+    """
+    encode line number to line number table (co_linetable).
+    every entry is a (byte length, line delta) pair that covers the instructions
+    from one line start to the next one.
+    see https://github.com/python/cpython/blob/3.10/Objects/lnotab_notes.txt
+    """
+    starts = [i for i, ins in enumerate(instructions) if ins.lineno is not None]
+    if not starts or starts[0] != 0:
+        # instructions before the first line start belong to the first line
+        starts.insert(0, 0)
+
+    prevline = firstlineno
+    for start, end in zip(starts, starts[1:] + [len(instructions)]):
+        lineno = instructions[start].lineno
+        if lineno is None:
+            lineno = prevline
+
+        # sdelta is unsigned, less than or equal to 0xfe
+        # ldelta is signed, -0x80 is reserved for "no line number"
+        sdelta, ldelta = _get_offset(end)-_get_offset(start), lineno-prevline
+        while ldelta > 0x7f:
+            yield from (0, 0x7f)
+            ldelta -= 0x7f
+        while ldelta < -0x7f:
+            yield from (0, 0x100 - 0x7f)
+            ldelta += 0x7f
+        while sdelta > 0xfe:
+            yield from (0xfe, ldelta % 0x100)
+            sdelta -= 0xfe
+            ldelta = 0
+        yield from (sdelta, ldelta % 0x100)
+
+        prevline = lineno
+
+
+def _label_not_defined(
+    code: types.CodeType,
+    goto: _Goto,
+    instructions: t.Sequence[_Instruction],
+    index: int
+) -> SyntaxError:
+    return _syntax_error(f"label {code.co_names[goto.target]!r} not defined in this function",
+                         instructions, index)
 
 
 def _find_goto_and_label(
     code: types.CodeType,
-    instructions: t.Sequence[_Instruction]
+    instructions: t.Sequence[_Instruction],
+    errors: t.Optional[t.List[SyntaxError]] = None
 ) -> t.Tuple[t.Sequence[_Goto], t.Dict[int, _Label]]:
-    """find gotos and labels"""
+    """
+    find gotos and labels.
+    if `errors` is given, the errors are appended to it instead of raised.
+    """
     gotos: t.List[_Goto] = []
     labels: t.Dict[int, _Label] = {}
 
@@ -412,6 +880,8 @@ def _find_goto_and_label(
 
         opname = dis.opname[ins.opcode]
         if opname in ("LOAD_GLOBAL", "LOAD_NAME"):
+            if i + 2 >= len(instructions):
+                continue
             load_attr, pop_top = instructions[i + 1], instructions[i + 2]
             if not (dis.opname[load_attr.opcode] == "LOAD_ATTR" and
                     dis.opname[pop_top.opcode] == "POP_TOP"):
@@ -421,8 +891,12 @@ def _find_goto_and_label(
                 gotos.append(_Goto(load_attr.arg, ins, tuple(block_stack)))
             elif code.co_names[ins.arg] == "label":
                 if load_attr.arg in labels:
-                    raise SyntaxError(f"ambiguous label name: {code.co_names[load_attr.arg]!r}."
-                                      f" at line {_take_min_lineno(instructions, i)}")
+                    error = _syntax_error(f"ambiguous label name: {code.co_names[load_attr.arg]!r}",
+                                          instructions, i)
+                    if errors is None:
+                        raise error
+                    errors.append(error)
+                    continue
 
                 labels[load_attr.arg] = _Label(ins, tuple(block_stack))
         elif opname in ("SETUP_FINALLY", "SETUP_WITH",
@@ -442,6 +916,133 @@ def _find_goto_and_label(
     return gotos, labels
 
 
+def _check(
+    code: types.CodeType,
+    jump_into_for: t.Container[t.Tuple[str, int]] = ()
+) -> t.Generator[SyntaxError, None, None]:
+    """
+    find every error that `patch` would raise for `code` and its nested code objects,
+    without rewriting the code.
+    `jump_into_for` is the (name, first line) of the functions patched with jump_into_for=True.
+    """
+    # skip decoding code objects that can't contain goto or label
+    if "goto" in code.co_names or "label" in code.co_names:
+        instructions = list(_get_instructions(code))
+        errors: t.List[SyntaxError] = []
+        gotos, labels = _find_goto_and_label(code, instructions, errors)
+        yield from errors
+
+        iterators: t.Optional[t.Dict[int, int]] = None
+        if (code.co_name, code.co_firstlineno) in jump_into_for:
+            iterators = {ins.id: 0 for i, ins in enumerate(instructions) if _is_for_loop(instructions, i)}
+
+        for goto in gotos:
+            index, _ = _find_by_id(instructions, goto.ins.id)
+            target_label = labels.get(goto.target, None)
+            if target_label is None:
+                yield _label_not_defined(code, goto, instructions, index)
+                continue
+
+            try:
+                for _ in _get_block_ins(instructions, list(code.co_consts),
+                                        goto.block, target_label.block, index, iterators):
+                    pass
+            except SyntaxError as e:
+                yield e
+
+    for const in code.co_consts:
+        if isinstance(const, types.CodeType):
+            yield from _check(const, jump_into_for)
+
+
+def _check_file(path: str) -> t.List[str]:
+    """check the gotos of a source file, returns the error messages"""
+    try:
+        source = pathlib.Path(path).read_bytes()
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore")
+            tree = ast.parse(source, path)
+            code = compile(tree, path, "exec", dont_inherit=True)
+    except SyntaxError as e:
+        return [f"{path}:{e.lineno}: {e.msg}"]
+    except (OSError, ValueError) as e:
+        return [f"{path}: {e}"]
+
+    jump_into_for = _find_jump_into_for(tree)
+    return [f"{path}:{error.lineno}: {error.msg}" for error in _check(code, jump_into_for)]
+
+
+def _find_jump_into_for(tree: ast.AST) -> t.Set[t.Tuple[str, int]]:
+    """
+    find the functions decorated with `with_goto(jump_into_for=True)`.
+    returns their (name, first line), the first line is the line of the first decorator
+    like `co_firstlineno`.
+    """
+    functions: t.Set[t.Tuple[str, int]] = set()
+    for node in ast.walk(tree):
+        if not isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef)):
+            continue
+
+        for decorator in node.decorator_list:
+            if not isinstance(decorator, ast.Call):
+                continue
+            name = getattr(decorator.func, "id", None) or getattr(decorator.func, "attr", None)
+            if name == "with_goto" and any(
+                keyword.arg == "jump_into_for"
+                and isinstance(keyword.value, ast.Constant)
+                and keyword.value.value is True
+                for keyword in decorator.keywords
+            ):
+                firstlineno = min([node.lineno] + [d.lineno for d in node.decorator_list])
+                functions.add((node.name, firstlineno))
+
+    return functions
+
+
+def _find_sources(path: pathlib.Path) -> t.Generator[pathlib.Path, None, None]:
+    """find the python files in `path`, skipping the hidden and virtualenv directories"""
+    for child in sorted(path.iterdir()):
+        if child.is_dir():
+            if (not child.is_symlink()
+                and not child.name.startswith(".")
+                and not (child / "pyvenv.cfg").exists()):
+                yield from _find_sources(child)
+        elif child.suffix == ".py":
+            yield child
+
+
+def _main(argv: t.Optional[t.Sequence[str]] = None) -> int:
+    parser = argparse.ArgumentParser(prog="python -m goto")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    check_parser = subparsers.add_parser(
+        "check",
+        help="find bad gotos in python files, without patching them"
+    )
+    check_parser.add_argument("paths", nargs="*", default=["."],
+                              help="files or directories to check (default: current directory)")
+    check_parser.add_argument("-j", "--jobs", type=int, default=None,
+                              help="number of processes (default: number of CPUs)")
+
+    args = parser.parse_args(argv)
+
+    files: t.List[str] = []
+    for path in map(pathlib.Path, args.paths):
+        if path.is_dir():
+            files.extend(map(str, _find_sources(path)))
+        else:
+            files.append(str(path))
+
+    errors = 0
+    with ProcessPoolExecutor(args.jobs) as executor:
+        for messages in executor.map(_check_file, files, chunksize=16):
+            for message in messages:
+                print(message)
+            errors += len(messages)
+
+    return 1 if errors else 0
+
+
 def _get_instructions(code: types.CodeType) -> t.Generator[_Instruction, None, None]:
     instructions = tuple(map(_Instruction.create, dis.get_instructions(code)))
     if _is_39():
@@ -477,6 +1078,22 @@ def _get_instructions(code: types.CodeType) -> t.Generator[_Instruction, None, N
         yield ins
 
 
+def _syntax_error(message: str, instructions: t.Sequence[_Instruction], index: int) -> SyntaxError:
+    """make a SyntaxError at the line of instructions[index]"""
+    return SyntaxError(message, (None, _take_min_lineno(instructions, index), None, None))
+
+
+@contextmanager
+def _error_filename(filename: str) -> t.Generator[None, None, None]:
+    """set the filename of the SyntaxError raised inside"""
+    try:
+        yield
+    except SyntaxError as e:
+        if e.filename is None:
+            e.filename = filename
+        raise
+
+
 def _take_min_lineno(instructions: t.Sequence[_Instruction], index: int) -> int:
     if (lineno := instructions[index].lineno) is not None:
         return lineno
@@ -510,3 +1127,7 @@ def _find_by_id(instructions: t.Iterable[_Instruction], id: int) -> t.Tuple[int,
             return i, ins
 
     return -1, None
+
+
+if __name__ == "__main__":
+    raise SystemExit(_main())
@@ -1,7 +1,13 @@
 # some tests were stolen from https://github.com/snoack/python-goto/blob/master/test_goto.py
 
 import dis
-from goto import with_goto, patch, goto, label
+import sys
+import inspect
+import types
+import importlib
+import textwrap
+from goto import with_goto, patch, repatch, entry, goto, label
+import goto as goto_module
 import pytest
 
 CODE = '''\
@@ -40,7 +46,8 @@ def test_range_as_function():
     assert with_goto(make_function(CODE.splitlines()))() == EXPECTED
 
 
-def test_EXTENDED_ARG():
+def make_EXTENDED_ARG_code():
+    """a goto over 2**12 labels, the jump needs EXTENDED_ARG"""
     code = []
     code.append('result = True')
     code.append('goto .foo')
@@ -48,7 +55,11 @@ def test_EXTENDED_ARG():
         code.append('label .l{0}'.format(i))
     code.append('result = "dead code"')
     code.append('label .foo')
-    assert with_goto(make_function(code))() is True
+    return code
+
+
+def test_EXTENDED_ARG():
+    assert with_goto(make_function(make_EXTENDED_ARG_code()))() is True
 
 
 def test_jump_out_of_loop():
@@ -254,3 +265,778 @@ def test_goto_except_block_2():
             label .exc
 
     pytest.raises(SyntaxError, with_goto, func)
+
+
+# line attribution, checked against dis.findlinestarts and sys.settrace
+
+def trace_lines(func, *args):
+    """returns the line events of func, relative to its first line (the decorator line, if any)"""
+    lines = []
+
+    def tracer(frame, event, arg):
+        if frame.f_code is not func.__code__:
+            return None
+        if event == 'line':
+            lines.append(frame.f_lineno - func.__code__.co_firstlineno)
+        return tracer
+
+    sys.settrace(tracer)
+    try:
+        func(*args)
+    finally:
+        sys.settrace(None)
+    return lines
+
+
+def trace_opcodes(func, *args):
+    """returns the (relative f_lineno, opname) of every executed instruction of func"""
+    opcodes = []
+
+    def tracer(frame, event, arg):
+        if frame.f_code is not func.__code__:
+            return None
+        frame.f_trace_opcodes = True
+        if event == 'opcode':
+            opname = dis.opname[func.__code__.co_code[frame.f_lasti]]
+            opcodes.append((frame.f_lineno - func.__code__.co_firstlineno, opname))
+        return tracer
+
+    sys.settrace(tracer)
+    try:
+        func(*args)
+    finally:
+        sys.settrace(None)
+    return opcodes
+
+
+def linestarts(code):
+    return [lineno - code.co_firstlineno for _, lineno in dis.findlinestarts(code)]
+
+
+def test_lineno_goto_forward():
+    @with_goto
+    def func():
+        x = 0
+        goto .skip
+        x = 1
+        label .skip
+        x += 2
+        return x
+
+    assert linestarts(func.__code__) == [2, 3, 4, 6, 7]
+    assert trace_lines(func) == [2, 3, 6, 7]
+
+
+def test_lineno_goto_backward():
+    @with_goto
+    def func():
+        i = 0
+        label .start
+        if i == 2:
+            goto .end
+        i += 1
+        goto .start
+        label .end
+        return i
+
+    assert trace_lines(func) == [2, 4, 6, 7, 4, 6, 7, 4, 5, 9]
+
+
+def test_lineno_label_on_same_line():
+    @with_goto
+    def func():
+        x = 0
+        goto .skip
+        x = 1
+        label .skip; x += 2
+        return x
+
+    assert linestarts(func.__code__) == [2, 3, 4, 5, 6]
+    assert trace_lines(func) == [2, 3, 5, 6]
+
+
+def test_lineno_goto_on_same_line():
+    @with_goto
+    def func():
+        x = 0; goto .skip
+        x = 1
+        label .skip
+        return x
+
+    assert linestarts(func.__code__) == [2, 3, 5]
+    assert trace_lines(func) == [2, 5]
+
+
+def test_lineno_implicit_block_ins():
+    # the inserted instructions are charged to the goto line
+    @with_goto
+    def func():
+        for i in range(10):
+            try:
+                goto .end
+            except Exception:
+                pass
+        label .end
+        return i
+
+    assert trace_lines(func) == [2, 3, 4, 8]
+
+    opcodes = trace_opcodes(func)
+    goto_opcodes = [opname for lineno, opname in opcodes if lineno == 4]
+    assert goto_opcodes == ['POP_BLOCK', 'POP_TOP', 'JUMP_ABSOLUTE']
+
+
+def test_lineno_large_decrease():
+    code = ['print(']
+    for _ in range(200):
+        code.append('    None,')
+    code.append(')')
+    code.append('result = None')
+    func = make_function(code)
+    original = func.__code__
+    modified = patch(original)
+
+    assert tuple(dis.findlinestarts(original)) == tuple(dis.findlinestarts(modified))
+
+
+def test_lineno_EXTENDED_ARG():
+    code = make_EXTENDED_ARG_code()
+    func = with_goto(make_function(code))
+
+    assert trace_lines(func) == [1, 2, len(code) + 1]
+
+
+@pytest.mark.skipif(sys.version_info[:2] != (3, 10), reason="co_linetable is used by python 3.10")
+def test_encode_lineno_310():
+    code = ['x = 1']
+    code.append('print(')
+    for _ in range(200):
+        code.append('    None,')
+    code.append(')')
+    code.extend([''] * 300)
+    code.append('result = x')
+    func = make_function(code)
+
+    instructions = list(goto_module._get_instructions(func.__code__))
+    linetable = bytes(goto_module._encode_lineno_310(func.__code__.co_firstlineno, instructions))
+    encoded = func.__code__.replace(co_linetable=linetable)
+
+    assert list(dis.findlinestarts(encoded)) == list(dis.findlinestarts(func.__code__))
+
+
+@pytest.mark.skipif(sys.version_info[:2] != (3, 10), reason="co_linetable is used by python 3.10")
+def test_encode_lineno_310_large_delta():
+    def func():
+        a = 1
+        b = 2
+        return a
+
+    instructions = list(goto_module._get_instructions(func.__code__))
+    instructions[0].lineno, instructions[2].lineno, instructions[4].lineno = 500, 100, 700
+    linetable = bytes(goto_module._encode_lineno_310(func.__code__.co_firstlineno, instructions))
+    encoded = func.__code__.replace(co_linetable=linetable)
+
+    assert list(encoded.co_lines()) == [(0, 4, 500), (4, 8, 100), (8, 12, 700)]
+
+
+
+# unused names and constants are removed
+
+def test_compact_names():
+    func = with_goto(make_function(make_EXTENDED_ARG_code()))
+
+    assert func.__code__.co_names == ()
+    assert func() is True
+
+
+def test_compact_names_in_use():
+    @with_goto
+    def func():
+        goto .end
+        label .end
+        return (goto, label, len)
+
+    assert func.__code__.co_names == ('goto', 'label', 'len')
+    assert func() == (goto, label, len)
+
+
+def test_compact_consts():
+    def func():
+        """docstring"""
+        goto .end
+        label .end
+        return 1
+
+    # add an unused constant
+    func.__code__ = func.__code__.replace(co_consts=func.__code__.co_consts + ('unused',))
+    code = patch(func.__code__)
+
+    assert code.co_consts == ('docstring', 1)
+    assert types.FunctionType(code, {})() == 1
+    assert types.FunctionType(code, {}).__doc__ == 'docstring'
+
+
+# patching again on reload
+
+MODULE = textwrap.dedent('''\
+    from goto import with_goto
+
+    @with_goto
+    def unchanged():
+        goto .end
+        print("dead code")
+        label .end
+        return "unchanged"
+
+    @with_goto
+    def changed():
+        goto .end
+        print("dead code")
+        label .end
+        return {0!r}
+
+    class Point:
+        def __init__(self):
+            self._x = 0
+
+        @property
+        @with_goto
+        def x(self):
+            goto .end
+            print("dead code")
+            label .end
+            return (self._x, {0!r})
+
+        @x.setter
+        @with_goto
+        def x(self, value):
+            goto .end
+            print("dead code")
+            label .end
+            self._x = value
+''')
+
+
+def load_module(tmp_path, monkeypatch, name, *values):
+    monkeypatch.syspath_prepend(str(tmp_path))
+    monkeypatch.setattr(sys, 'dont_write_bytecode', True)
+    path = tmp_path / f'{name}.py'
+
+    path.write_text(MODULE.format(values[0]))
+    module = importlib.import_module(name)
+    yield module
+
+    for value in values[1:]:
+        path.write_text(MODULE.format(value))
+        yield importlib.reload(module)
+
+
+def test_reload(tmp_path, monkeypatch):
+    loader = load_module(tmp_path, monkeypatch, 'goto_reload', 'old', 'new')
+    module = next(loader)
+    unchanged, changed = module.unchanged, module.changed
+    unchanged_code = unchanged.__code__
+    point = module.Point()
+    point.x = 1
+    assert changed() == 'old'
+    assert point.x == (1, 'old')
+
+    module = next(loader)
+    # the unchanged function reuses the patched code
+    assert module.unchanged.__code__ is unchanged_code
+    assert module.changed() == 'new'
+    # references to the old functions run the new code
+    assert changed() == 'new'
+    assert unchanged() == 'unchanged'
+    # the getter and setter of a property have the same qualified name
+    assert point.x == (1, 'new')
+    point.x = 2
+    assert point.x == (2, 'new')
+
+
+def test_repatch(tmp_path, monkeypatch):
+    module = next(load_module(tmp_path, monkeypatch, 'goto_repatch', 'old'))
+    changed = module.changed
+    unchanged_code = module.unchanged.__code__
+
+    # replace the code without reloading the module, as a code reloader does
+    ns = {}
+    exec(MODULE.format('new').replace('@with_goto', ''), ns)
+    changed.__code__ = ns['changed'].__code__
+    repatch(module)
+
+    assert module.unchanged.__code__ is unchanged_code
+    assert changed() == 'new'
+    assert 'goto' not in changed.__code__.co_names
+
+
+def test_same_qualname():
+    # separate function objects with the same qualified name keep their own code
+    def make(flag):
+        if flag:
+            @with_goto
+            def handler():
+                goto .end
+                label .end
+                return 'A'
+        else:
+            @with_goto
+            def handler():
+                goto .end
+                label .end
+                return 'B'
+        return handler
+
+    a = make(True)
+    b = make(False)
+    assert (a(), b()) == ('A', 'B')
+
+
+def test_same_qualname_closure():
+    def outer():
+        x, y = 1, 2
+
+        @with_goto
+        def inner():
+            goto .end
+            label .end
+            return (x, y)
+        return inner
+
+    i1 = outer()
+
+    def outer():
+        y, x = 1, 2
+
+        @with_goto
+        def inner():
+            goto .end
+            label .end
+            return (y, x, 'redefined')
+        return inner
+
+    i2 = outer()
+    assert i1() == (1, 2)
+    assert i2() == (1, 2, 'redefined')
+
+
+# python -m goto check
+
+def test_return_global():
+    # LOAD_GLOBAL is one of the last two instructions
+    @with_goto
+    def func():
+        return len
+
+    assert func() is len
+
+
+def test_syntax_error_lineno():
+    def func():
+        goto .unknown
+
+    with pytest.raises(SyntaxError) as excinfo:
+        with_goto(func)
+    assert excinfo.value.filename == func.__code__.co_filename
+    assert excinfo.value.lineno == func.__code__.co_firstlineno + 1
+
+
+CHECK_MODULE = textwrap.dedent('''\
+    def func():
+        goto .missing
+        label .dup
+        label .dup
+        for i in range(10):
+            label .loop
+        goto .loop
+
+    def good():
+        goto .end
+        label .end
+''')
+
+CHECK_JUMP_INTO_FOR_MODULE = textwrap.dedent('''\
+    import goto
+
+    @goto.with_goto(jump_into_for=True)
+    def into_loop():
+        goto .loop
+        for i in range(10):
+            label .loop
+
+    @goto.with_goto
+    def into_loop_2():
+        goto .loop
+        for i in range(10):
+            label .loop
+''')
+
+
+def test_check(tmp_path, capsys):
+    (tmp_path / 'bad.py').write_text(CHECK_MODULE)
+    (tmp_path / 'pkg').mkdir()
+    (tmp_path / 'pkg' / 'invalid.py').write_text('def func(:\n')
+    (tmp_path / 'pkg' / 'good.py').write_text('x = len\n')
+    # hidden and virtualenv directories are skipped
+    (tmp_path / '.hidden').mkdir()
+    (tmp_path / '.hidden' / 'bad.py').write_text(CHECK_MODULE)
+    (tmp_path / 'venv').mkdir()
+    (tmp_path / 'venv' / 'pyvenv.cfg').write_text('')
+    (tmp_path / 'venv' / 'bad.py').write_text(CHECK_MODULE)
+
+    assert goto_module._main(['check', str(tmp_path)]) == 1
+    assert capsys.readouterr().out.splitlines() == [
+        f"{tmp_path / 'bad.py'}:4: ambiguous label name: 'dup'",
+        f"{tmp_path / 'bad.py'}:2: label 'missing' not defined in this function",
+        f"{tmp_path / 'bad.py'}:7: can't jump into 'with', 'for', 'except', and 'finally' block",
+        f"{tmp_path / 'pkg' / 'invalid.py'}:1: invalid syntax",
+    ]
+
+    assert goto_module._main(['check', str(tmp_path / 'pkg' / 'good.py')]) == 0
+    assert capsys.readouterr().out == ''
+
+
+
+def test_check_jump_into_for(tmp_path, capsys):
+    # the mode is read from the decorator of each function
+    (tmp_path / 'loops.py').write_text(CHECK_JUMP_INTO_FOR_MODULE)
+
+    assert goto_module._main(['check', str(tmp_path)]) == 1
+    assert capsys.readouterr().out.splitlines() == [
+        f"{tmp_path / 'loops.py'}:11: can't jump into 'with', 'for', 'except', and 'finally' block",
+    ]
+
+
+# alternate entry points
+
+def test_entry():
+    @with_goto
+    def func(n):
+        total = 0
+        i = 0
+        label .loop
+        if i == n:
+            return total
+        total += i
+        i += 1
+        goto .loop
+
+    resume = entry(func, 'loop')
+    assert func(10) == 45
+    assert resume(n=10, i=5, total=0) == 35
+    # the variants are cached per label
+    assert entry(func, 'loop').__code__ is resume.__code__
+    # the other local variables are unbound
+    pytest.raises(UnboundLocalError, resume, n=10, i=5)
+
+
+def test_entry_try_block():
+    @with_goto
+    def func():
+        x = None
+        try:
+            label .block
+            raise ValueError(x)
+        except ValueError as e:
+            return e.args[0]
+
+    assert entry(func, 'block')(x=42) == 42
+
+
+def test_entry_closure():
+    y = 1
+
+    def func(a):
+        label .start
+        return (lambda: a + y)()
+
+    assert entry(func, 'start')(a=2) == 3
+
+
+def test_entry_cell():
+    # total only lives in a cell
+    @with_goto
+    def func(n):
+        total = 0
+        i = 0
+        label .loop
+        if i == n:
+            return (lambda: total)()
+        total += i
+        i += 1
+        goto .loop
+
+    assert entry(func, 'loop')(n=10, i=5, total=10) == 45
+    pytest.raises(NameError, entry(func, 'loop'), n=10, i=5)
+
+
+def test_entry_defaults():
+    @with_goto
+    def func(n, step=2, *, start=1):
+        i = start
+        label .loop
+        if i >= n:
+            return (i, start)
+        i += step
+        goto .loop
+
+    resume = entry(func, 'loop')
+    assert resume(n=10, i=0) == (10, 1)
+    assert resume(n=10, i=0, step=3) == (12, 1)
+    assert resume(n=10, i=0, start=5) == (10, 5)
+
+
+def test_entry_var_parameters():
+    @with_goto
+    def func(x, *rest, **kw):
+        label .end
+        kw.setdefault('x', x)
+        return (rest, kw)
+
+    resume = entry(func, 'end')
+    assert resume(x=1) == ((), {'x': 1})
+    assert resume(x=2) == ((), {'x': 2})
+    assert resume(x=1, rest=(2,), kw={'y': 3}) == ((2,), {'y': 3, 'x': 1})
+    assert "=<unbound>" in str(inspect.signature(resume))
+
+
+def test_entry_same_qualname():
+    def make(flag):
+        if flag:
+            @with_goto
+            def func():
+                label .loop
+                return 'first'
+        else:
+            @with_goto
+            def func():
+                label .loop
+                return 'second'
+        return func
+
+    assert entry(make(True), 'loop')() == 'first'
+    assert entry(make(False), 'loop')() == 'second'
+
+    class Box:
+        @property
+        @with_goto
+        def value(self):
+            label .get
+            return self._value
+
+        @value.setter
+        @with_goto
+        def value(self, value):
+            label .set
+            self._value = value
+
+    box = Box()
+    entry(Box.value.fset, 'set')(self=box, value=1)
+    assert entry(Box.value.fget, 'get')(self=box) == 1
+
+
+def test_entry_jump_into_for():
+    @with_goto(jump_into_for=True)
+    def func(items):
+        result = []
+        label .start
+        for x in items:
+            result.append(x)
+            if x == 1:
+                goto .later
+            label .resume
+        goto .end
+
+        label .later
+        result.append('*')
+        goto .resume
+
+        label .end
+        return result
+
+    assert entry(func, 'start')(items=[1, 2], result=['!']) == ['!', 1, '*', 2]
+
+
+def test_entry_unknown_label():
+    def func():
+        label .start
+
+    pytest.raises(ValueError, entry, func, 'unknown')
+
+
+def test_entry_into_loop():
+    def func():
+        for i in range(10):
+            label .loop
+
+    pytest.raises(SyntaxError, entry, func, 'loop')
+
+
+# jump into for loops (jump_into_for=True)
+
+def test_jump_into_loop_iterator():
+    @with_goto(jump_into_for=True)
+    def func(items):
+        result = []
+        done = False
+        for x in items:
+            result.append(x)
+            if x == 2:
+                goto .insert
+            label .resume
+        done = True
+        label .insert
+        if done:
+            return result
+        result.append('*')
+        goto .resume
+
+    assert func([1, 2, 3, 4]) == [1, 2, '*', 3, 4]
+
+
+def test_jump_into_nested_loops_iterator():
+    @with_goto(jump_into_for=True)
+    def func():
+        result = []
+        done = False
+        for i in range(2):
+            for j in range(2):
+                result.append((i, j))
+                if (i, j) == (0, 0):
+                    goto .insert
+                label .resume
+        done = True
+        label .insert
+        if done:
+            return result
+        result.append('*')
+        goto .resume
+
+    assert func() == [(0, 0), '*', (0, 1), (1, 0), (1, 1)]
+
+
+def test_jump_across_loops_iterator():
+    # fused loops, jump from a loop body into another loop body
+    @with_goto(jump_into_for=True)
+    def func():
+        result = []
+        started = False
+        for i in 'abc':
+            result.append(i)
+            if not started:
+                goto .start
+            goto .next_j
+            label .next_i
+        goto .end
+
+        label .start
+        started = True
+        for j in range(3):
+            result.append(j)
+            goto .next_i
+            label .next_j
+
+        label .end
+        return result
+
+    assert func() == ['a', 0, 'b', 1, 'c', 2]
+
+
+def test_jump_into_loop_finished():
+    # the iterator is deleted when the loop is exhausted
+    @with_goto(jump_into_for=True)
+    def func():
+        result = []
+        for i in range(3):
+            if i == 1:
+                goto .inner
+            for j in 'ab':
+                label .inner
+                result.append((i, j))
+        return result
+
+    pytest.raises(UnboundLocalError, func)
+
+    # or left by break
+    @with_goto(jump_into_for=True)
+    def func(skip):
+        result = []
+        if skip:
+            goto .end
+        for i in range(3):
+            result.append(i)
+            if i == 1:
+                break
+            label .body
+        else:
+            result.append('else')
+        label .end
+        if len(result) == 2:
+            goto .body
+        return result
+
+    assert func(True) == []
+    pytest.raises(UnboundLocalError, func, False)
+
+
+def test_jump_between_sibling_blocks():
+    def try_to_try():
+        try:
+            goto .other
+        except ValueError:
+            pass
+        try:
+            label .other
+        except TypeError:
+            pass
+
+    def except_to_try():
+        try:
+            pass
+        except ValueError:
+            goto .other
+        try:
+            label .other
+        except TypeError:
+            pass
+
+    def with_to_try(lock):
+        with lock:
+            goto .other
+        try:
+            label .other
+        except TypeError:
+            pass
+
+    for func in (try_to_try, except_to_try, with_to_try):
+        with pytest.raises(SyntaxError, match='jump into different block'):
+            with_goto(func)
+
+    # allowed with jump_into_for, the try block is entered again
+    @with_goto(jump_into_for=True)
+    def func():
+        result = []
+        try:
+            result.append(1)
+            goto .other
+        except ValueError:
+            pass
+        try:
+            label .other
+            result.append(2)
+            raise TypeError
+        except TypeError:
+            result.append(3)
+        return result
+
+    assert func() == [1, 2, 3]
+
+
+def test_jump_into_loop_not_started():
+    @with_goto(jump_into_for=True)
+    def func():
+        goto .loop
+        for i in range(10):
+            label .loop
+
+    pytest.raises(UnboundLocalError, func)